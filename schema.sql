@@ -309,6 +309,25 @@ CREATE TABLE IF NOT EXISTS video_analysis (
     updated_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Cache de respostas do Gemini
+-- Chave = SHA256(conteúdo do vídeo + prompt + modelo + parâmetros)
+-- Permite re-rodar análises (modo replay) sem re-upload/custo de API
+CREATE TABLE IF NOT EXISTS gemini_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    response JSONB NOT NULL,
+    model_used VARCHAR(50),
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Uploads ainda ativos no servidor do Gemini (expiram em 48h lá)
+-- Evita re-upload + espera de PROCESSING quando o mesmo arquivo volta
+CREATE TABLE IF NOT EXISTS gemini_uploads (
+    sha256 VARCHAR(64) PRIMARY KEY,
+    file_name VARCHAR(255) NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
 -- ============================================================================
 -- MOMENTOS-CHAVE E FRAMES
 -- ============================================================================
@@ -5,8 +5,11 @@ Analisa vídeos do YouTube usando Gemini 1.5 Flash com upload direto do vídeo.
 """
 
 import os
+import re
 import sys
+import asyncio
 import json
+import logging
 import time
 import hashlib
 import subprocess
@@ -14,10 +17,43 @@ from pathlib import Path
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import Json, RealDictCursor, execute_values
 import google.generativeai as genai
 
+# JSON rápido quando disponível (orjson é extensão C, 2-5x mais rápido
+# na resposta grande do Gemini); cai no json da stdlib sem ele
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# Paralelismo de subprocessos ffmpeg (opcional); threads bastam porque
+# subprocess.run libera o GIL
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
+# Logging: detalhes por frame só em DEBUG; em batch, centenas de prints
+# com flush síncrono no TTY custam mais que o trabalho em si
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(message)s"
+)
+log = logging.getLogger("video_analyzer")
+
 # Configuração
 DB_CONFIG = {
     "host": os.getenv("DB_HOST", "host.docker.internal"),
@@ -28,6 +64,21 @@ DB_CONFIG = {
 }
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-1.5-flash"
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "max_output_tokens": 8192,
+}
+
+# Cache de respostas do Gemini: enabled | replay | disabled
+# "replay" usa apenas o cache (erro em caso de miss) para iterar sem custo
+CACHE_MODE = os.getenv("CACHE_MODE", "enabled")
+
+# ID de vídeo do YouTube em URLs normais, curtas, Shorts e embeds
+_YT_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/|embed/)([A-Za-z0-9_-]{11})')
+
+# Cercas de código markdown nas bordas da resposta do Gemini
+_FENCE_STRIP = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
 DATA_DIR = Path(os.getenv("DATA_DIR", "/data/comfyui_kb"))
 FRAMES_DIR = DATA_DIR / "frames"
 VIDEOS_DIR = DATA_DIR / "videos"
@@ -107,27 +158,89 @@ Foque especialmente em momentos onde a UI do ComfyUI está visível.
 """
 
 
+# Pool compartilhado: evita um handshake TCP+auth+TLS por chamada e os
+# erros de "remaining connection slots" no modo batch
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Retorna o pool de conexões, criando-o na primeira chamada."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = psycopg2.pool.ThreadedConnectionPool(1, 8, **DB_CONFIG)
+            atexit.register(_POOL.closeall)
+        return _POOL
+
+
+def _reset_pool_after_fork():
+    """Descarta o pool herdado via fork (workers do process_batch).
+
+    As conexões herdadas compartilham o mesmo fd com o pai: usá-las (ou
+    fechá-las no atexit do filho) misturaria tráfego do protocolo e
+    derrubaria a conexão dos outros processos. Cada filho cria o seu
+    pool na primeira chamada a _get_pool.
+    """
+    global _POOL, _POOL_LOCK
+    _POOL = None
+    _POOL_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
 class DatabaseConnection:
-    """Gerencia conexão com PostgreSQL."""
-    
+    """Gerencia conexão com PostgreSQL via pool compartilhado."""
+
     def __init__(self):
         self.conn = None
-        
+
     def __enter__(self):
-        self.conn = psycopg2.connect(**DB_CONFIG)
+        self.conn = _get_pool().getconn()
         return self.conn
-    
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
             if exc_type:
                 self.conn.rollback()
             else:
                 self.conn.commit()
-            self.conn.close()
+            _get_pool().putconn(self.conn)
+            self.conn = None
 
 
-def check_rate_limit(api_name: str = "gemini_flash") -> bool:
-    """Verifica se podemos fazer uma requisição respeitando rate limits."""
+# Limites locais (requisições/minuto), espelhando api_configs do schema
+_RATE_LIMITS = {
+    "gemini_flash": 15,
+    "gemini_pro": 2,
+    "youtube_data": 100,
+    "github": 60,
+}
+_DEFAULT_RATE_PER_MIN = 15
+
+# Intervalo entre reconciliações com o contador compartilhado no Postgres
+_BUCKET_SYNC_INTERVAL = 60
+
+# api_name -> {"tokens": float, "last": monotonic, "rate": req/min, "synced": monotonic}
+_buckets: Dict[str, Dict[str, float]] = {}
+_BUCKETS_LOCK = threading.Lock()
+
+# Fração da cota atribuída a este processo (r = R/E): o process_batch
+# divide os limites locais entre os E workers via initializer, senão
+# cada processo acharia que tem a cota inteira para si
+_RATE_LIMIT_SHARE = 1
+
+
+def _set_rate_limit_share(n_workers: int):
+    """Divide os limites locais de rate/TPM entre os processos do batch."""
+    global _RATE_LIMIT_SHARE
+    _RATE_LIMIT_SHARE = max(int(n_workers), 1)
+
+
+def _db_check_rate_limit(api_name: str) -> bool:
+    """Consulta o contador compartilhado de rate limit no Postgres."""
     with DatabaseConnection() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -138,15 +251,124 @@ def check_rate_limit(api_name: str = "gemini_flash") -> bool:
             return result[0] if result else False
 
 
+def _refill_bucket(api_name: str) -> Dict[str, float]:
+    """Atualiza os tokens do bucket pelo tempo decorrido (chamar com lock)."""
+    now = time.monotonic()
+    rate = _RATE_LIMITS.get(api_name, _DEFAULT_RATE_PER_MIN) / _RATE_LIMIT_SHARE
+    bucket = _buckets.setdefault(api_name, {
+        "tokens": float(rate), "last": now, "rate": float(rate), "synced": 0.0
+    })
+    elapsed = now - bucket["last"]
+    bucket["tokens"] = min(bucket["rate"], bucket["tokens"] + elapsed * bucket["rate"] / 60.0)
+    bucket["last"] = now
+    return bucket
+
+
+def check_rate_limit(api_name: str = "gemini_flash") -> bool:
+    """Verifica se podemos fazer uma requisição respeitando rate limits.
+
+    Token bucket em processo: o caminho comum (tokens disponíveis) não
+    toca o banco; o contador compartilhado no Postgres só é consultado
+    a cada _BUCKET_SYNC_INTERVAL para manter justiça entre workers.
+    """
+    with _BUCKETS_LOCK:
+        bucket = _refill_bucket(api_name)
+
+        if bucket["tokens"] < 1.0:
+            return False
+
+        if bucket["last"] - bucket["synced"] >= _BUCKET_SYNC_INTERVAL:
+            bucket["synced"] = bucket["last"]
+            if not _db_check_rate_limit(api_name):
+                # Outro worker esgotou a cota compartilhada
+                bucket["tokens"] = 0.0
+                return False
+
+        bucket["tokens"] -= 1.0
+        return True
+
+
+def _rate_limit_wait_time(api_name: str) -> float:
+    """Tempo (s) até o próximo token ficar disponível."""
+    with _BUCKETS_LOCK:
+        bucket = _refill_bucket(api_name)
+        if bucket["tokens"] >= 1.0:
+            return 0.0
+        return (1.0 - bucket["tokens"]) * 60.0 / bucket["rate"]
+
+
+# Orçamento de tokens/minuto (TPM). Nunca chamamos o endpoint remoto de
+# count-tokens: estimamos localmente antes da requisição e reconciliamos
+# com o usage_metadata da resposta depois (economiza 1 RTT por análise)
+_TPM_LIMITS = {
+    "gemini_flash": 1_000_000,
+    "gemini_pro": 32_000,
+}
+
+# Custo aproximado do vídeo em tokens (Gemini amostra ~1 fps)
+VIDEO_TOKENS_ESTIMATE = int(os.getenv("VIDEO_TOKENS_ESTIMATE", "100000"))
+
+# api_name -> {"tokens": float, "last": monotonic}
+_token_budgets: Dict[str, Dict[str, float]] = {}
+
+
+def _estimate_tokens(context: str) -> int:
+    """Estimativa local de tokens (~4 chars/token) + custo do vídeo."""
+    return len(context) // 4 + VIDEO_TOKENS_ESTIMATE
+
+
+def _acquire_tokens(api_name: str, estimated: int, max_wait: int = 300):
+    """Reserva tokens do orçamento TPM local, aguardando refill se preciso."""
+    limit = _TPM_LIMITS.get(api_name)
+    if not limit:
+        return
+    limit = limit / _RATE_LIMIT_SHARE
+
+    waited = 0.0
+    while True:
+        with _BUCKETS_LOCK:
+            now = time.monotonic()
+            budget = _token_budgets.setdefault(api_name, {"tokens": float(limit), "last": now})
+            elapsed = now - budget["last"]
+            budget["tokens"] = min(float(limit), budget["tokens"] + elapsed * limit / 60.0)
+            budget["last"] = now
+
+            if budget["tokens"] >= estimated or estimated >= limit:
+                budget["tokens"] -= estimated
+                return
+
+            wait_time = (estimated - budget["tokens"]) * 60.0 / limit
+
+        if waited >= max_wait:
+            raise Exception(f"Orçamento de tokens não liberou após {max_wait}s")
+        wait_time = min(wait_time, max_wait - waited)
+        print(f"Orçamento de tokens baixo, aguardando {wait_time:.1f}s...")
+        time.sleep(wait_time)
+        waited += wait_time
+
+
+def reconcile_tokens(api_name: str, actual: int, estimated: int):
+    """Ajusta o orçamento TPM pelo consumo real do usage_metadata."""
+    if api_name not in _TPM_LIMITS:
+        return
+    with _BUCKETS_LOCK:
+        budget = _token_budgets.get(api_name)
+        if budget is not None:
+            # Pode ficar negativo momentaneamente; o refill compensa
+            budget["tokens"] -= (actual - estimated)
+
+
 def wait_for_rate_limit(api_name: str = "gemini_flash", max_wait: int = 120):
     """Aguarda até que o rate limit permita uma requisição."""
-    waited = 0
+    waited = 0.0
     while not check_rate_limit(api_name):
         if waited >= max_wait:
             raise Exception(f"Rate limit não liberou após {max_wait}s")
-        print(f"Rate limit atingido, aguardando... ({waited}s)")
-        time.sleep(10)
-        waited += 10
+        wait_time = max(_rate_limit_wait_time(api_name), 0.1)
+        wait_time = min(wait_time, max_wait - waited)
+        print(f"Rate limit atingido, aguardando {wait_time:.1f}s... ({waited:.0f}s)")
+        time.sleep(wait_time)
+        waited += wait_time
     print("Rate limit OK, prosseguindo...")
 
 
@@ -160,6 +382,9 @@ def download_video(video_url: str, output_path: Path, max_height: int = 720) ->
         "-o", str(output_path),
         "--no-playlist",
         "--no-warnings",
+        # Fragmentos HTTP em paralelo: download limitado por rede, não CPU
+        "--concurrent-fragments", "4",
+        "--http-chunk-size", "10485760",
         video_url
     ]
     
@@ -177,65 +402,374 @@ def download_video(video_url: str, output_path: Path, max_height: int = 720) ->
         return False
 
 
+def prepare_for_gemini(video_path: Path) -> Path:
+    """Gera uma versão compacta do vídeo para upload ao Gemini.
+
+    O Gemini 1.5 Flash amostra o vídeo a ~1 fps, então reencodar a
+    1 fps/360p sem áudio encolhe o arquivo 10-30x e corta o tempo de
+    upload na mesma proporção. O original é mantido para a extração de
+    frames (os timestamps se referem a ele).
+    """
+    lite_path = video_path.with_name("video_lite.mp4")
+
+    def build_cmd(hw_args, hw_vf):
+        return [
+            "ffmpeg",
+            *hw_args,
+            "-i", str(video_path),
+            "-vf", f"{hw_vf}fps=1,scale=640:-2",
+            "-c:v", "libx264",
+            "-crf", "30",
+            "-preset", "veryfast",
+            "-an",
+            "-movflags", "+faststart",
+            str(lite_path),
+            "-y"
+        ]
+
+    try:
+        result = _run_ffmpeg(build_cmd, timeout=600)
+        if result.returncode == 0 and lite_path.exists():
+            ratio = video_path.stat().st_size / max(lite_path.stat().st_size, 1)
+            print(f"Vídeo compactado para upload ({ratio:.1f}x menor)")
+            return lite_path
+        print(f"Falha ao compactar vídeo, usando original: {result.stderr[-300:]}")
+    except Exception as e:
+        print(f"Erro ao compactar vídeo, usando original: {e}")
+
+    return video_path
+
+
 def extract_frame(video_path: Path, timestamp_seconds: int, output_path: Path) -> bool:
     """Extrai um frame específico do vídeo usando FFmpeg."""
-    cmd = [
-        "ffmpeg",
-        "-ss", str(timestamp_seconds),
-        "-i", str(video_path),
-        "-vframes", "1",
-        "-q:v", "2",
-        str(output_path),
-        "-y"
-    ]
-    
+    def build_cmd(hw_args, hw_vf):
+        cmd = [
+            "ffmpeg",
+            *hw_args,
+            "-ss", str(timestamp_seconds),
+            "-i", str(video_path),
+        ]
+        if hw_vf:
+            cmd += ["-vf", hw_vf.rstrip(",")]
+        cmd += [
+            "-vframes", "1",
+            "-q:v", "2",
+            str(output_path),
+            "-y"
+        ]
+        return cmd
+
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        _run_ffmpeg(build_cmd, timeout=30)
         return output_path.exists()
     except Exception as e:
         print(f"Erro ao extrair frame: {e}")
         return False
 
 
+def _detect_hwaccel() -> List[str]:
+    """Detecta suporte a decode por hardware no FFmpeg (NVDEC/CUDA).
+
+    Pode ser forçado via FFMPEG_HWACCEL=cuda ou desabilitado com
+    FFMPEG_HWACCEL=none. A listagem de -hwaccels reflete o build, não a
+    presença de GPU, então toda invocação com hwaccel tem retry em CPU
+    (ver _run_ffmpeg). O decoder fica a cargo do ffmpeg, que escolhe o
+    NVDEC certo por codec (H.264/VP9/AV1...).
+    """
+    override = os.getenv("FFMPEG_HWACCEL", "").lower()
+    if override in ("none", "cpu", "off"):
+        return []
+
+    if not override:
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-hwaccels"],
+                capture_output=True, text=True, timeout=10
+            )
+            if "cuda" not in result.stdout:
+                return []
+        except Exception:
+            return []
+    elif override != "cuda":
+        return []
+
+    return [
+        "-hwaccel", "cuda",
+        "-hwaccel_output_format", "cuda",
+    ]
+
+
+# Probe único na importação; decode por GPU libera CPU para os workers de IO
+HWACCEL_ARGS = _detect_hwaccel()
+
+# Frames decodificados na GPU precisam voltar para a RAM antes do encoder JPEG
+_HWDOWNLOAD_VF = "hwdownload,format=nv12," if HWACCEL_ARGS else ""
+
+
+def _run_ffmpeg(build_cmd, timeout: int):
+    """Executa ffmpeg; se falhar com hwaccel ativo, repete uma vez em CPU.
+
+    Cobre builds que listam cuda sem GPU presente e codecs sem decoder
+    NVDEC (VP9/AV1 conforme a placa). `build_cmd(hw_args, hw_vf)` monta o
+    comando com ou sem os argumentos de hardware.
+    """
+    result = subprocess.run(
+        build_cmd(HWACCEL_ARGS, _HWDOWNLOAD_VF),
+        capture_output=True, text=True, timeout=timeout
+    )
+    if result.returncode != 0 and HWACCEL_ARGS:
+        log.debug("ffmpeg falhou com hwaccel, repetindo em CPU")
+        result = subprocess.run(
+            build_cmd([], ""),
+            capture_output=True, text=True, timeout=timeout
+        )
+    return result
+
+
+# Linha do showinfo com o pts_time de cada frame emitido
+_SHOWINFO_PTS_RE = re.compile(r"pts_time:(\d+(?:\.\d+)?)")
+
+# Janela (em segundos) aceita ao redor de cada timestamp pedido
+_FRAME_WINDOW = 0.5
+
+
+def _cluster_timestamps(timestamps: List[int]) -> Dict[int, List[int]]:
+    """Agrupa timestamps quase duplicados (distância <= 1s).
+
+    O LLM emite momentos independentes, então 42 e 43 costumam ser a
+    mesma cena; um frame por cluster basta. Retorna {representante
+    (mediana): [timestamps originais]}.
+    """
+    clusters: List[List[int]] = []
+    for ts in sorted(set(timestamps)):
+        if clusters and ts - clusters[-1][-1] <= 1:
+            clusters[-1].append(ts)
+        else:
+            clusters.append([ts])
+
+    return {cluster[len(cluster) // 2]: cluster for cluster in clusters}
+
+
 def extract_frames_batch(video_path: Path, timestamps: List[int], output_dir: Path) -> Dict[int, Path]:
-    """Extrai múltiplos frames de uma vez."""
+    """Extrai múltiplos frames em um único passe de decode do FFmpeg.
+
+    Em vez de um processo ffmpeg por timestamp (N seeks + N decodes),
+    monta um filtro select com todos os timestamps e decodifica o vídeo
+    uma única vez. O stderr do showinfo mapeia cada frame emitido de
+    volta ao timestamp pedido. Timestamps a <= 1s de distância
+    compartilham o mesmo frame.
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
+
+    if not timestamps:
+        return {}
+
+    clusters = _cluster_timestamps(timestamps)
+    sorted_ts = sorted(clusters)
+    if len(sorted_ts) < len(set(timestamps)):
+        log.debug("%d timestamps quase duplicados agrupados",
+                  len(set(timestamps)) - len(sorted_ts))
+
+    select_expr = "+".join(
+        f"between(t,{ts},{ts}+{_FRAME_WINDOW})" for ts in sorted_ts
+    )
+    pattern = output_dir / "frame_%05d.jpg"
+
+    def build_cmd(hw_args, hw_vf):
+        return [
+            "ffmpeg",
+            *hw_args,
+            "-i", str(video_path),
+            "-vf", f"{hw_vf}select='{select_expr}',showinfo",
+            "-vsync", "vfr",
+            "-q:v", "2",
+            str(pattern),
+            "-y"
+        ]
+
+    try:
+        result = _run_ffmpeg(build_cmd, timeout=300)
+    except Exception as e:
+        print(f"Erro ao extrair frames em batch: {e}")
+        return _expand_clusters(
+            _extract_frames_individually(video_path, sorted_ts, output_dir), clusters)
+
+    if result.returncode != 0:
+        print(f"FFmpeg falhou no modo batch, usando extração individual: {result.stderr[-300:]}")
+        return _expand_clusters(
+            _extract_frames_individually(video_path, sorted_ts, output_dir), clusters)
+
+    # Mapear frames emitidos de volta aos timestamps pedidos: a numeração
+    # sequencial do muxer segue a ordem das linhas do showinfo
     results = {}
-    
-    for ts in timestamps:
+    pts_times = [float(m) for m in _SHOWINFO_PTS_RE.findall(result.stderr)]
+
+    for i, pts_time in enumerate(pts_times, 1):
+        emitted = output_dir / f"frame_{i:05d}.jpg"
+        if not emitted.exists():
+            continue
+
+        ts = next(
+            (t for t in sorted_ts if t <= pts_time < t + _FRAME_WINDOW + 0.1),
+            None
+        )
+
+        if ts is None or ts in results:
+            # Frame extra da mesma janela, descartar
+            emitted.unlink()
+            continue
+
         frame_path = output_dir / f"frame_{ts:05d}s.jpg"
-        if extract_frame(video_path, ts, frame_path):
-            results[ts] = frame_path
-            print(f"  ✓ Frame extraído: {ts}s")
+        emitted.rename(frame_path)
+        results[ts] = frame_path
+        log.debug("Frame extraído: %ss", ts)
+
+    if not results:
+        # Sucesso do ffmpeg mas nada mapeado (ex.: stderr fora do esperado):
+        # limpar sobras numeradas e cair para a extração individual
+        for leftover in output_dir.glob("frame_[0-9][0-9][0-9][0-9][0-9].jpg"):
+            leftover.unlink()
+        print("Batch não produziu frames mapeáveis, usando extração individual")
+        return _expand_clusters(
+            _extract_frames_individually(video_path, sorted_ts, output_dir), clusters)
+
+    missing = [ts for ts in sorted_ts if ts not in results]
+    for ts in missing:
+        log.debug("Falha ao extrair frame: %ss", ts)
+
+    expanded = _expand_clusters(results, clusters)
+    log.info("Extraídos %d/%d frames (%d clusters)",
+             len(results), len(sorted_ts), len(clusters))
+    return expanded
+
+
+def _expand_clusters(rep_results: Dict[int, Path], clusters: Dict[int, List[int]]) -> Dict[int, Path]:
+    """Propaga o frame de cada representante para todos os timestamps do cluster."""
+    results = {}
+    for rep, path in rep_results.items():
+        for member in clusters.get(rep, [rep]):
+            results[member] = path
+    return results
+
+
+def _extract_frames_individually(video_path: Path, timestamps: List[int], output_dir: Path) -> Dict[int, Path]:
+    """Fallback: extrai um frame por processo ffmpeg, em paralelo.
+
+    Cada chamada é um subprocesso (o GIL fica livre), então threads
+    escalam quase linearmente; n_jobs limitado para não saturar o disco.
+    """
+    paths = {ts: output_dir / f"frame_{ts:05d}s.jpg" for ts in timestamps}
+    n_jobs = min(8, os.cpu_count() or 1, max(len(timestamps), 1))
+
+    if Parallel is not None:
+        extracted = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(extract_frame)(video_path, ts, paths[ts]) for ts in timestamps
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            extracted = list(executor.map(
+                lambda ts: extract_frame(video_path, ts, paths[ts]), timestamps
+            ))
+
+    results = {}
+    for ts, ok in zip(timestamps, extracted):
+        if ok:
+            results[ts] = paths[ts]
+            log.debug("Frame extraído: %ss", ts)
         else:
-            print(f"  ✗ Falha ao extrair frame: {ts}s")
-    
+            log.debug("Falha ao extrair frame: %ss", ts)
+
+    log.info("Extraídos %d/%d frames (modo individual)", len(results), len(timestamps))
     return results
 
 
-def analyze_video_with_gemini(video_path: Path, title: str = "", description: str = "") -> Dict[str, Any]:
-    """Analisa vídeo usando Gemini 1.5 Flash com upload direto."""
-    
+def _sha256_file(path: Path) -> str:
+    """SHA-256 do arquivo em streaming, sem carregar na RAM."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        # Fallback: loop com buffer reutilizado de 1 MiB
+        h = hashlib.sha256()
+        buf = bytearray(1 << 20)
+        mv = memoryview(buf)
+        while True:
+            n = f.readinto(mv)
+            if not n:
+                break
+            h.update(mv[:n])
+        return h.hexdigest()
+
+
+def _cache_key(video_sha: str, prompt: str) -> str:
+    """Chave de cache: conteúdo do vídeo + prompt + modelo + parâmetros."""
+    h = hashlib.sha256()
+    h.update(video_sha.encode())
+    h.update(prompt.encode())
+    h.update(GEMINI_MODEL.encode())
+    h.update(str(GENERATION_CONFIG["temperature"]).encode())
+    h.update(str(GENERATION_CONFIG["max_output_tokens"]).encode())
+    return h.hexdigest()
+
+
+def _cache_lookup(key: str) -> Optional[Dict[str, Any]]:
+    """Busca resposta cacheada do Gemini; None em caso de miss."""
+    with DatabaseConnection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT response FROM gemini_cache WHERE cache_key = %s", (key,))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+
+def _cache_store(key: str, analysis: Dict[str, Any]):
+    """Guarda resposta do Gemini no cache."""
+    with DatabaseConnection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO gemini_cache (cache_key, response, model_used)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (cache_key) DO NOTHING
+            """, (key, Json(analysis, dumps=_json_dumps), GEMINI_MODEL))
+
+
+def _lookup_upload(video_sha: str) -> Optional[str]:
+    """Busca um upload ainda ativo no Gemini para este conteúdo."""
+    with DatabaseConnection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT file_name FROM gemini_uploads
+                WHERE sha256 = %s AND expires_at > NOW() + INTERVAL '1 hour'
+            """, (video_sha,))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+
+def _store_upload(video_sha: str, file_name: str):
+    """Registra um upload para reaproveitamento (Gemini expira em 48h)."""
+    with DatabaseConnection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO gemini_uploads (sha256, file_name, expires_at)
+                VALUES (%s, %s, NOW() + INTERVAL '47 hours')
+                ON CONFLICT (sha256) DO UPDATE SET
+                    file_name = EXCLUDED.file_name,
+                    expires_at = EXCLUDED.expires_at
+            """, (video_sha, file_name))
+
+
+async def analyze_video_with_gemini_async(video_path: Path, title: str = "", description: str = "") -> Dict[str, Any]:
+    """Analisa vídeo usando Gemini 1.5 Flash com upload direto.
+
+    Versão async: o upload e a espera de PROCESSING não bloqueiam o event
+    loop, então várias análises podem ser intercaladas em um processo só
+    (ex.: asyncio.gather sobre vários vídeos).
+    """
+
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY não configurada")
-    
+
     genai.configure(api_key=GEMINI_API_KEY)
-    
-    # Upload do vídeo
-    print(f"Fazendo upload do vídeo para Gemini...")
-    video_file = genai.upload_file(path=str(video_path))
-    
-    # Aguardar processamento
-    print("Aguardando processamento do vídeo...")
-    while video_file.state.name == "PROCESSING":
-        time.sleep(5)
-        video_file = genai.get_file(video_file.name)
-    
-    if video_file.state.name != "ACTIVE":
-        raise Exception(f"Falha no processamento do vídeo: {video_file.state.name}")
-    
-    print("Vídeo processado, iniciando análise...")
-    
+
     # Criar prompt com contexto
     context = f"""
 Título do vídeo: {title}
@@ -247,32 +781,85 @@ Descrição:
 
 {VIDEO_ANALYSIS_PROMPT}
 """
-    
-    # Chamar Gemini
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    
-    response = model.generate_content(
+
+    video_sha = _sha256_file(video_path)
+
+    # Verificar cache antes de pagar upload + análise de novo
+    cache_key = None
+    if CACHE_MODE != "disabled":
+        cache_key = _cache_key(video_sha, context)
+        try:
+            cached = _cache_lookup(cache_key)
+        except Exception as e:
+            print(f"Cache indisponível, prosseguindo sem: {e}")
+            cached = None
+        if cached is not None:
+            print("Análise encontrada no cache, pulando Gemini")
+            return cached
+        if CACHE_MODE == "replay":
+            raise Exception(f"CACHE_MODE=replay e análise não está no cache ({cache_key})")
+
+    # Reaproveitar upload ainda ativo no servidor (mesmo conteúdo)
+    video_file = None
+    try:
+        cached_name = _lookup_upload(video_sha)
+    except Exception:
+        cached_name = None
+    if cached_name:
+        try:
+            candidate = await asyncio.to_thread(genai.get_file, cached_name)
+            if candidate.state.name == "ACTIVE":
+                print("Upload anterior ainda ativo no Gemini, pulando upload")
+                video_file = candidate
+        except Exception:
+            video_file = None
+
+    if video_file is None:
+        # Upload do vídeo (em thread: a lib não expõe cliente async de upload)
+        print(f"Fazendo upload do vídeo para Gemini...")
+        video_file = await asyncio.to_thread(genai.upload_file, path=str(video_path))
+
+        # Aguardar processamento
+        print("Aguardando processamento do vídeo...")
+        while video_file.state.name == "PROCESSING":
+            await asyncio.sleep(5)
+            video_file = await asyncio.to_thread(genai.get_file, video_file.name)
+
+        if video_file.state.name != "ACTIVE":
+            raise Exception(f"Falha no processamento do vídeo: {video_file.state.name}")
+
+        try:
+            _store_upload(video_sha, video_file.name)
+        except Exception as e:
+            print(f"Falha ao registrar upload (ignorando): {e}")
+
+    print("Vídeo processado, iniciando análise...")
+
+    # Chamar Gemini (orçamento de tokens estimado localmente, sem count-tokens)
+    estimated_tokens = _estimate_tokens(context)
+    await asyncio.to_thread(_acquire_tokens, "gemini_flash", estimated_tokens)
+
+    model = genai.GenerativeModel(GEMINI_MODEL)
+
+    response = await asyncio.to_thread(
+        model.generate_content,
         [video_file, context],
-        generation_config={
-            "temperature": 0.2,
-            "max_output_tokens": 8192,
-        }
+        generation_config=GENERATION_CONFIG
     )
+
+    actual_tokens = response.usage_metadata.total_token_count if hasattr(response, 'usage_metadata') else estimated_tokens
+    reconcile_tokens("gemini_flash", actual=actual_tokens, estimated=estimated_tokens)
     
-    # Limpar arquivo do servidor
-    try:
-        genai.delete_file(video_file.name)
-    except:
-        pass
-    
-    # Parsear resposta
-    text = response.text
-    
-    # Limpar possíveis marcadores de código
-    text = text.replace("```json", "").replace("```", "").strip()
+    # Não apagar o arquivo do servidor: ele expira sozinho em 48h e pode
+    # ser reaproveitado por outra análise do mesmo conteúdo (gemini_uploads)
+
+
+    # Parsear resposta, removendo possíveis cercas de código nas bordas
+    # (regex ancorada: evita duas varreduras/cópias do corpo inteiro)
+    text = _FENCE_STRIP.sub("", response.text).strip()
     
     try:
-        analysis = json.loads(text)
+        analysis = _json_loads(text)
     except json.JSONDecodeError as e:
         print(f"Erro ao parsear JSON: {e}")
         print(f"Resposta raw: {text[:500]}...")
@@ -284,17 +871,52 @@ Descrição:
     
     # Adicionar metadados
     analysis["_metadata"] = {
-        "model": "gemini-1.5-flash",
+        "model": GEMINI_MODEL,
         "analyzed_at": datetime.now().isoformat(),
         "tokens_used": response.usage_metadata.total_token_count if hasattr(response, 'usage_metadata') else 0
     }
-    
+
+    # Guardar no cache para reprocessamentos futuros
+    if cache_key is not None and "error" not in analysis:
+        try:
+            _cache_store(cache_key, analysis)
+        except Exception as e:
+            print(f"Falha ao gravar no cache (ignorando): {e}")
+
     return analysis
 
 
-def save_analysis_to_db(video_id: int, analysis: Dict[str, Any]):
-    """Salva análise no banco de dados."""
-    
+def analyze_video_with_gemini(video_path: Path, title: str = "", description: str = "") -> Dict[str, Any]:
+    """Wrapper síncrono de analyze_video_with_gemini_async."""
+    return asyncio.run(
+        analyze_video_with_gemini_async(video_path, title=title, description=description)
+    )
+
+
+def _chunks(iterable, size: int):
+    """Itera em lotes de até `size` itens."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def save_analysis_to_db(video_id: int, analysis: Dict[str, Any],
+                        extracted_frames: Optional[Dict[int, Path]] = None):
+    """Salva análise (e paths de frames, se houver) no banco de dados.
+
+    Receber `extracted_frames` aqui evita abrir uma segunda conexão em
+    process_video só para gravar os paths: tudo sai na mesma transação.
+    """
+
+    # Embrulhado em Json, o dict é serializado uma única vez e adaptado
+    # direto para a coluna jsonb
+    raw_response_param = Json(analysis, dumps=_json_dumps)
+
     with DatabaseConnection() as conn:
         with conn.cursor() as cur:
             # Inserir análise principal
@@ -332,16 +954,18 @@ def save_analysis_to_db(video_id: int, analysis: Dict[str, Any]):
                 analysis.get("models_mentioned", []),
                 analysis.get("custom_nodes_mentioned", []),
                 analysis.get("prerequisites", []),
-                json.dumps(analysis),
+                raw_response_param,
                 analysis.get("_metadata", {}).get("model", "gemini-1.5-flash"),
                 analysis.get("_metadata", {}).get("tokens_used", 0)
             ))
             
             analysis_id = cur.fetchone()[0]
             
-            # Inserir momentos-chave
-            for moment in analysis.get("key_moments", []):
-                cur.execute("""
+            # Inserir momentos-chave em lotes de 100, mantendo o buffer
+            # SQL do execute_values em O(lote)
+            total_moments = 0
+            for batch in _chunks(analysis.get("key_moments", []), 100):
+                execute_values(cur, """
                     INSERT INTO video_moments (
                         video_id,
                         timestamp_seconds,
@@ -350,27 +974,48 @@ def save_analysis_to_db(video_id: int, analysis: Dict[str, Any]):
                         description,
                         nodes_visible,
                         importance_score
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ) VALUES %s
                     ON CONFLICT DO NOTHING
-                """, (
-                    video_id,
-                    moment.get("timestamp_seconds", 0),
-                    moment.get("timestamp_formatted", "00:00"),
-                    moment.get("type", "other"),
-                    moment.get("description", ""),
-                    moment.get("nodes_visible", []),
-                    moment.get("importance", 5)
-                ))
-            
+                """, [
+                    (
+                        video_id,
+                        moment.get("timestamp_seconds", 0),
+                        moment.get("timestamp_formatted", "00:00"),
+                        moment.get("type", "other"),
+                        moment.get("description", ""),
+                        moment.get("nodes_visible", []),
+                        moment.get("importance", 5)
+                    )
+                    for moment in batch
+                ])
+                total_moments += len(batch)
+
+            # Gravar paths dos frames extraídos em um único round-trip
+            if extracted_frames:
+                execute_values(cur, """
+                    UPDATE video_moments
+                    SET frame_path = data.path
+                    FROM (VALUES %s) AS data(vid, ts, path)
+                    WHERE video_id = data.vid AND timestamp_seconds = data.ts
+                """, [
+                    (video_id, ts, str(frame_path))
+                    for ts, frame_path in extracted_frames.items()
+                ], template="(%s, %s, %s)")
+
+            if extracted_frames is not None:
+                cur.execute("""
+                    UPDATE videos SET frames_status = 'completed' WHERE id = %s
+                """, (video_id,))
+
             # Atualizar status do vídeo
             cur.execute("""
-                UPDATE videos SET 
+                UPDATE videos SET
                     analysis_status = 'completed',
                     updated_at = NOW()
                 WHERE id = %s
             """, (video_id,))
             
-            print(f"Análise salva: analysis_id={analysis_id}, {len(analysis.get('key_moments', []))} momentos")
+            print(f"Análise salva: analysis_id={analysis_id}, {total_moments} momentos")
             
             return analysis_id
 
@@ -391,8 +1036,7 @@ def process_video(video_id: int = None, video_url: str = None, skip_download: bo
                 """, (video_id,))
             elif video_url:
                 # Extrair video ID do URL
-                import re
-                match = re.search(r'(?:v=|youtu\.be/)([a-zA-Z0-9_-]{11})', video_url)
+                match = _YT_ID_RE.search(video_url)
                 if not match:
                     raise ValueError(f"URL inválida: {video_url}")
                 external_id = match.group(1)
@@ -429,12 +1073,13 @@ def process_video(video_id: int = None, video_url: str = None, skip_download: bo
     else:
         print("Usando vídeo já baixado")
     
-    # 2. Análise com Gemini
+    # 2. Análise com Gemini (upload da versão compacta)
     print("\nIniciando análise com Gemini...")
+    upload_path = prepare_for_gemini(video_path)
     wait_for_rate_limit("gemini_flash")
-    
+
     analysis = analyze_video_with_gemini(
-        video_path,
+        upload_path,
         title=video['title'],
         description=video.get('description', '')
     )
@@ -445,36 +1090,24 @@ def process_video(video_id: int = None, video_url: str = None, skip_download: bo
     print(f"  - Técnicas: {analysis.get('techniques', [])}")
     print(f"  - Dificuldade: {analysis.get('difficulty', 'N/A')}")
     
-    # 3. Salvar análise no banco
-    analysis_id = save_analysis_to_db(video['id'], analysis)
-    
-    # 4. Extrair frames dos momentos importantes
+    # 3. Extrair frames dos momentos importantes
     moments = analysis.get("key_moments", [])
+    extracted = None
     if moments:
         print(f"\nExtraindo frames de {len(moments)} momentos...")
-        
+
         timestamps = [m.get("timestamp_seconds", 0) for m in moments]
         frames_dir = FRAMES_DIR / str(video['id'])
-        
+
         extracted = extract_frames_batch(video_path, timestamps, frames_dir)
-        
-        # Atualizar paths no banco
-        with DatabaseConnection() as conn:
-            with conn.cursor() as cur:
-                for ts, frame_path in extracted.items():
-                    cur.execute("""
-                        UPDATE video_moments
-                        SET frame_path = %s
-                        WHERE video_id = %s AND timestamp_seconds = %s
-                    """, (str(frame_path), video['id'], ts))
-                
-                cur.execute("""
-                    UPDATE videos SET frames_status = 'completed' WHERE id = %s
-                """, (video['id'],))
-        
         print(f"  ✓ {len(extracted)} frames extraídos")
-    
-    # 5. Limpar vídeo (manter apenas frames)
+
+    # 4. Salvar análise + paths dos frames em uma única transação
+    analysis_id = save_analysis_to_db(video['id'], analysis, extracted_frames=extracted)
+
+    # 5. Limpar vídeos (manter apenas frames)
+    if upload_path != video_path and upload_path.exists():
+        upload_path.unlink()
     if video_path.exists():
         video_path.unlink()
         print("Vídeo temporário removido")
@@ -487,9 +1120,14 @@ def process_video(video_id: int = None, video_url: str = None, skip_download: bo
     return analysis
 
 
-def process_batch(limit: int = 10, source_id: int = None):
-    """Processa múltiplos vídeos pendentes."""
-    
+def process_batch(limit: int = 10, source_id: int = None, workers: int = 4):
+    """Processa múltiplos vídeos pendentes em paralelo.
+
+    O trabalho é limitado pelas APIs remotas (Gemini/YouTube), não por
+    CPU, então alguns workers bastam para saturar; a coordenação de cota
+    continua no rate limiter compartilhado via Postgres.
+    """
+
     with DatabaseConnection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             query = """
@@ -510,19 +1148,41 @@ def process_batch(limit: int = 10, source_id: int = None):
             videos = cur.fetchall()
     
     print(f"Encontrados {len(videos)} vídeos para processar\n")
-    
-    for i, video in enumerate(videos, 1):
-        print(f"\n[{i}/{len(videos)}] {video['title'][:50]}...")
-        try:
-            process_video(video_id=video['id'])
-        except Exception as e:
-            print(f"❌ Erro: {e}")
-            continue
-        
-        # Pausa entre vídeos para respeitar rate limits
-        if i < len(videos):
-            print("Aguardando 5s antes do próximo...")
-            time.sleep(5)
+
+    if not videos:
+        return
+
+    if workers <= 1:
+        # Modo serial (útil para debug)
+        for i, video in enumerate(videos, 1):
+            print(f"\n[{i}/{len(videos)}] {video['title'][:50]}...")
+            try:
+                process_video(video_id=video['id'])
+            except Exception as e:
+                print(f"❌ Erro: {e}")
+        return
+
+    titles = {video['id']: video['title'] for video in videos}
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_set_rate_limit_share,
+        initargs=(workers,)
+    ) as executor:
+        futures = {
+            executor.submit(process_video, video_id=video['id']): video['id']
+            for video in videos
+        }
+
+        done = 0
+        for future in as_completed(futures):
+            video_id = futures[future]
+            done += 1
+            try:
+                future.result()
+                print(f"\n[{done}/{len(videos)}] ✓ {titles[video_id][:50]}")
+            except Exception as e:
+                print(f"\n[{done}/{len(videos)}] ❌ Erro em '{titles[video_id][:50]}': {e}")
 
 
 if __name__ == "__main__":
@@ -533,13 +1193,14 @@ if __name__ == "__main__":
     parser.add_argument("--video-url", type=str, help="URL do vídeo YouTube")
     parser.add_argument("--batch", action="store_true", help="Processar batch de vídeos pendentes")
     parser.add_argument("--limit", type=int, default=10, help="Limite de vídeos no batch")
+    parser.add_argument("--workers", type=int, default=4, help="Workers paralelos no batch")
     parser.add_argument("--source-id", type=int, help="Filtrar por source_id")
     parser.add_argument("--skip-download", action="store_true", help="Pular download se vídeo existir")
     
     args = parser.parse_args()
     
     if args.batch:
-        process_batch(limit=args.limit, source_id=args.source_id)
+        process_batch(limit=args.limit, source_id=args.source_id, workers=args.workers)
     elif args.video_id or args.video_url:
         process_video(
             video_id=args.video_id,